@@ -1,18 +1,43 @@
-import os, time, json, hashlib, datetime as dt, logging, requests
-from functools import wraps
-from flask import Flask, jsonify, request, send_from_directory
+import os, re, time, hmac, base64, hashlib, threading, datetime as dt, logging, requests
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+from contextlib import contextmanager
+from dataclasses import dataclass
+from functools import lru_cache, wraps
+from flask import Flask, g, jsonify, request, send_file, send_from_directory
+from flask.json.provider import DefaultJSONProvider
 from flask_cors import CORS
+from flask_compress import Compress
+from gevent import get_hub
+from gevent.monkey import is_module_patched
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import orjson
 import psycopg2
 from psycopg2 import pool as psycopool
-from psycopg2.extras import RealDictCursor
+from psycopg2.extras import RealDictCursor, execute_values
+
+class ORJSONProvider(DefaultJSONProvider):
+    def dumps(self, obj, **kw):
+        return orjson.dumps(obj, default=self.default, option=orjson.OPT_NON_STR_KEYS).decode()
+
+    def loads(self, s, **kw):
+        return orjson.loads(s)
 
 app = Flask(__name__, static_folder=None)
-CORS(app, supports_credentials=False)
+app.json = ORJSONProvider(app)
+CORS(app, supports_credentials=False, expose_headers=["X-Next-After"])
+app.config.update(COMPRESS_ALGORITHM=["br", "gzip"], COMPRESS_MIN_SIZE=500, COMPRESS_LEVEL=5, COMPRESS_BR_LEVEL=5)
+Compress(app)
 app.logger.setLevel(logging.INFO)
 
 APP_SECRET = os.getenv("APP_SECRET", "dev-secret-change-me")
+APP_SECRET_BYTES = APP_SECRET.encode()
+PIN_SCRYPT_N = 2 ** 14
+TOKEN_KEY = hashlib.blake2b(APP_SECRET_BYTES, digest_size=32).digest()
 MM_USER = os.getenv("MM_USERNAME")
 MM_PASS = os.getenv("MM_PASSWORD")
+NOMINATIM_LANG = os.getenv("NOMINATIM_LANG", "en")
+NOMINATIM_CONTACT = {"email": os.environ["NOMINATIM_EMAIL"]} if os.getenv("NOMINATIM_EMAIL") else {}
 
 DB_CFG = dict(
     host=os.getenv("POSTGRES_HOST", "db"),
@@ -20,40 +45,172 @@ DB_CFG = dict(
     dbname=os.getenv("POSTGRES_DB", "nasa2025"),
     user=os.getenv("POSTGRES_USER", "nasa2025"),
     password=os.getenv("POSTGRES_PASSWORD", "nasa2025"),
+    connect_timeout=int(os.getenv("POSTGRES_CONNECT_TIMEOUT", "5")),
+    keepalives=1,
+    keepalives_idle=30,
+    keepalives_interval=10,
 )
 
+PREPARED_SQL = {
+    "upsert_user": "WITH ins AS (INSERT INTO app_users(username,pin_hash) VALUES($1,$2) ON CONFLICT(username) DO NOTHING RETURNING id,pin_hash) SELECT id,pin_hash FROM ins UNION ALL SELECT id,pin_hash FROM app_users WHERE username=$1 AND NOT EXISTS (SELECT 1 FROM ins)",
+    "select_user": "SELECT id,pin_hash FROM app_users WHERE username=$1",
+    "events_version": "SELECT count(*),max(id),sum(hashtextextended(id::text||','||updated_at::text,0)) FROM events WHERE user_id=$1",
+    "list_events": "SELECT coalesce(json_agg(e ORDER BY e.date,e.id),'[]')::text FROM (SELECT id,event_name,date::text AS date,city,country,lat,lon FROM events WHERE user_id=$1) e",
+    "list_events_page": "SELECT coalesce(json_agg(e ORDER BY e.date,e.id),'[]')::text,count(*),(array_agg(e.date||','||e.id ORDER BY e.date DESC,e.id DESC))[1] FROM (SELECT id,event_name,date::text AS date,city,country,lat,lon FROM events WHERE user_id=$1 AND (events.date,id)>($2,$3) ORDER BY events.date,id LIMIT $4) e",
+    "select_event": "SELECT event_name,date::text AS date,lat,lon FROM events WHERE id=$1 AND user_id=$2",
+    "select_events": "SELECT id,event_name,date::text AS date,lat,lon FROM events WHERE user_id=$1 AND id=ANY($2)",
+    "update_event": "UPDATE events SET event_name=$1,date=$2,city=$3,country=$4,lat=$5,lon=$6,updated_at=NOW() WHERE id=$7 AND user_id=$8 RETURNING id,event_name,date::text AS date,city,country,lat,lon",
+    "update_pin": "UPDATE app_users SET pin_hash=$1 WHERE id=$2",
+    "insert_event": "INSERT INTO events(user_id,event_name,date,city,country,lat,lon) VALUES($1,$2,$3,$4,$5,$6,$7) RETURNING id,event_name,date::text AS date,city,country,lat,lon",
+}
+
+class PreparingConnection(psycopg2.extensions.connection):
+    def __init__(self, *a, **kw):
+        super().__init__(*a, **kw)
+        self.prepared = set()
+
+def _execute_prepared(cur, name, args):
+    conn = cur.connection
+    if name not in conn.prepared:
+        cur.execute(f"PREPARE {name} AS {PREPARED_SQL[name]}")
+        conn.prepared.add(name)
+    cur.execute(f"EXECUTE {name}({','.join(['%s'] * len(args))})", args)
+
+DB_POOL_MIN = int(os.getenv("DB_POOL_MIN", "2"))
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", "0"))
+DB_POOL_MAX_CAP = int(os.getenv("DB_POOL_MAX_CAP", "32"))
+DB_POOL_PCT = float(os.getenv("DB_POOL_PCT", "0.4"))
+DB_POOL_WAIT = float(os.getenv("DB_POOL_WAIT", "10"))
+WEB_WORKERS = int(os.getenv("WEB_CONCURRENCY", "1"))
+
 db_pool = None
+DB_POOL_LOCK = threading.Lock()
+DB_SLOTS = None
+HTTP = requests.Session()
+HTTP.headers["User-Agent"] = "Plan4Cast/1.0"
+HTTP_ADAPTER = HTTPAdapter(pool_connections=8, pool_maxsize=32, max_retries=Retry(total=2, read=False, backoff_factor=0.2, status_forcelist=(502, 503, 504)))
+HTTP.mount("https://", HTTP_ADAPTER)
+HTTP.mount("http://", HTTP_ADAPTER)
+PREFETCHING = set()
+UPSTREAM_POOL = ThreadPoolExecutor(max_workers=int(os.getenv("UPSTREAM_WORKERS", "8")), thread_name_prefix="upstream")
+BATCH_POOL = ThreadPoolExecutor(max_workers=int(os.getenv("BATCH_UPSTREAM_WORKERS", "4")), thread_name_prefix="batch")
+STATIC_DIR = "/app/static"
+INDEX_HTML = os.path.join(STATIC_DIR, "index.html")
+STATIC_MAX_AGE = 60 * 60 * 24
+HTTP_MAX_AGE_COUNTRIES = 60 * 60 * 24
+HTTP_MAX_AGE_CITIES = 60 * 60 * 12
 COUNTRY_CACHE = {"ts": 0, "data": []}
-CITY_CACHE = {}
+COUNTRY_REFRESH = threading.Lock()
+COUNTRY_RETRY = {"at": 0}
+BUNDLED_COUNTRIES_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "countries.json")
+COUNTRY_CACHE_FILE = os.getenv("COUNTRY_CACHE_FILE", "/tmp/plan4cast/countries.json")
 STATIC_CITIES = {}
+STATIC_CITIES_BY_COUNTRY = {}
 CACHE_TTL_COUNTRIES = 60 * 60 * 24 * 7
 CACHE_TTL_CITIES = 60 * 60 * 24 * 3
+CACHE_TTL_FORECAST = 60 * 15
+CACHE_TTL_CURRENT = 60 * 10
+CACHE_TTL_CLIMATE = 60 * 60 * 24
+CACHE_TTL_GEOCODE = 60 * 60 * 24 * 7
+CACHE_TTL_OBSERVED = 60 * 60 * 24 * 30
+CACHE_TTL_NEGATIVE = 60
+CACHE_MAX_ENTRIES = 10000
+NASA_POWER_URL = ("https://power.larc.nasa.gov/api/temporal/daily/point"
+                  "?parameters=T2M_MAX,T2M_MIN,PRECTOTCORR,ALLSKY_SFC_SW_DWN"
+                  "&community=RE&longitude={lon:.4f}&latitude={lat:.4f}"
+                  "&start={day}&end={day}&format=JSON")
+MM_SUMMARY_PARAMS = "t_max_2m_24h:C,t_min_2m_24h:C,precip_24h:mm,wind_gusts_10m_24h:ms"
+MAX_BYTES_MM = 256_000
+MAX_BYTES_NASA = 64_000
+NASA_FILL_VALUE = -999
+MAX_BYTES_GEOCODE = 64_000
+MAX_BYTES_COUNTRIES = 1_000_000
+UPSTREAM_TIMEOUT_MM = 16
+UPSTREAM_TIMEOUT_NASA = 13
+BULK_EVENTS_MAX = 500
+SUGGEST_BATCH_MAX = 100
+EVENTS_PAGE_DEFAULT = 200
+EVENTS_PAGE_MAX = 1000
+EVENTS_CACHE = {}
+WX_DESC = ("Unknown", "Clear", "Mostly clear", "Partly cloudy", "Overcast", "Fog", "Light rain", "Rain", "Heavy rain", "Snow", "Thunderstorms")
+HOT_TMAX_C = 33
+WET_PRECIP_MM = 10
+COOL_TMAX_C = 18
+CONDITION_TIPS = {
+    "very hot": ("bring shade/canopy", "portable fans", "stay hydrated"),
+    "very wet": ("raincoat", "waterproof bag", "check shelter options"),
+    "cool": ("light jacket",),
+}
+CATEGORY_TIPS = {
+    "drone": ("check wind before flight", "bring ND filters", "spare batteries", "consider skipping if winds exceed 10 m/s"),
+    "celebration": ("confirm canopy vendor", "backup indoor location", "protect photo gear"),
+    "outing": ("cooler with ice", "sunscreen", "ground mat"),
+    "hike": ("hydration pack", "insect repellent", "trail shoes"),
+}
+KEYWORD_CATEGORY = {
+    "drone": "drone", "flying": "drone", "aerial": "drone",
+    "wedding": "celebration", "ceremony": "celebration", "party": "celebration",
+    "picnic": "outing", "bbq": "outing", "beach": "outing", "park": "outing",
+    "hike": "hike", "trail": "hike", "trek": "hike",
+}
+PIN_RE = re.compile(r"\d{4}")
+COMPRESS_ETAG_SUFFIX = re.compile(r':(?:br|gzip|deflate|zstd)"')
+EVENT_PATTERN = re.compile("|".join(map(re.escape, KEYWORD_CATEGORY)))
 
 def init_db_pool():
-    global db_pool
+    global db_pool, DB_SLOTS
     if db_pool:
         return
-    deadline = time.time() + 60
-    last_err = None
-    while time.time() < deadline:
-        try:
-            db_pool = psycopg2.pool.SimpleConnectionPool(minconn=1, maxconn=8, **DB_CFG)
-            conn = db_pool.getconn()
-            with conn, conn.cursor() as cur:
-                cur.execute("SELECT 1;")
-            db_pool.putconn(conn)
-            break
-        except Exception as e:
-            last_err = e
-            app.logger.warning(f"[DB wait] {e}")
-            time.sleep(2)
-    if not db_pool:
-        raise RuntimeError(f"Database not reachable: {last_err}")
-    ensure_schema()
+    with DB_POOL_LOCK:
+        if db_pool:
+            return
+        deadline = time.time() + 60
+        last_err = None
+        max_connections = 100
+        while time.time() < deadline:
+            try:
+                if not db_pool:
+                    db_pool = psycopg2.pool.ThreadedConnectionPool(minconn=DB_POOL_MIN, maxconn=DB_POOL_MAX or DB_POOL_MAX_CAP, connection_factory=PreparingConnection, **DB_CFG)
+                    DB_SLOTS = threading.BoundedSemaphore(db_pool.maxconn)
+                with get_conn() as conn, conn, conn.cursor() as cur:
+                    cur.execute("SHOW max_connections;")
+                    max_connections = int(cur.fetchone()[0])
+                break
+            except Exception as e:
+                last_err = e
+                app.logger.warning(f"[DB wait] {e}")
+                time.sleep(2)
+        if not db_pool:
+            raise RuntimeError(f"Database not reachable: {last_err}")
+        if not DB_POOL_MAX:
+            db_pool.maxconn = max(DB_POOL_MIN, 4, min(DB_POOL_MAX_CAP, int(max_connections * DB_POOL_PCT / WEB_WORKERS)))
+            DB_SLOTS = threading.BoundedSemaphore(db_pool.maxconn)
+        app.logger.info(f"[DB pool] maxconn={db_pool.maxconn}")
+        ensure_schema()
+
+def _checkout():
+    if not DB_SLOTS.acquire(timeout=DB_POOL_WAIT):
+        raise psycopg2.pool.PoolError("connection pool exhausted")
+    try:
+        return db_pool.getconn()
+    except Exception:
+        DB_SLOTS.release()
+        raise
 
-def ensure_schema():
-    conn = db_pool.getconn()
+def _checkin(conn):
+    db_pool.putconn(conn)
+    DB_SLOTS.release()
+
+@contextmanager
+def get_conn():
+    conn = _checkout()
     try:
+        yield conn
+    finally:
+        _checkin(conn)
+
+def ensure_schema():
+    with get_conn() as conn:
         with conn:
             with conn.cursor() as cur:
                 cur.execute("SELECT pg_advisory_lock(420420);")
@@ -78,102 +235,363 @@ def ensure_schema():
                 );""")
                 cur.execute("""ALTER TABLE events ADD COLUMN IF NOT EXISTS updated_at TIMESTAMPTZ DEFAULT NOW();""")
                 cur.execute("CREATE INDEX IF NOT EXISTS idx_users_username ON app_users(username);")
-                cur.execute("CREATE INDEX IF NOT EXISTS idx_events_user ON events(user_id, date);")
+                cur.execute("CREATE INDEX IF NOT EXISTS idx_events_user_date_id ON events(user_id, date, id) INCLUDE (event_name, city, country, lat, lon, updated_at);")
+                cur.execute("DROP INDEX IF EXISTS idx_events_user;")
                 cur.execute("SELECT pg_advisory_unlock(420420);")
-    finally:
-        db_pool.putconn(conn)
 
-def _hash_pin(username, pin):
+def _legacy_pin_hash(username, pin):
     return hashlib.sha256(f"{username}:{pin}:{APP_SECRET}".encode()).hexdigest()
 
+def _scrypt(data, salt):
+    return hashlib.scrypt(data, salt=salt, n=PIN_SCRYPT_N, r=8, p=1, dklen=32)
+
+def _hash_pin(username, pin, salt=None):
+    salt = salt or os.urandom(16)
+    data = f"{username}:{pin}:{APP_SECRET}".encode()
+    # scrypt holds the CPU for tens of ms; keep it off the gevent hub so other greenlets keep running.
+    key = get_hub().threadpool.apply(_scrypt, (data, salt)) if is_module_patched("threading") else _scrypt(data, salt)
+    return f"scrypt${salt.hex()}${key.hex()}"
+
+def _check_pin(username, pin, stored):
+    if stored.startswith("scrypt$"):
+        salt = bytes.fromhex(stored.split("$")[1])
+        return hmac.compare_digest(_hash_pin(username, pin, salt), stored)
+    return hmac.compare_digest(_legacy_pin_hash(username, pin), stored)
+
+def _b64(raw):
+    return base64.urlsafe_b64encode(raw).rstrip(b"=")
+
+def _mac(data):
+    return _b64(hashlib.blake2b(data, key=TOKEN_KEY, digest_size=32).digest())
+
+def _legacy_mac(data):
+    # Original sha256(data+secret) hex tokens; they carry a 7-day exp, so drop this one release after the BLAKE2b switch.
+    return hashlib.sha256(data + APP_SECRET_BYTES).hexdigest().encode()
+
 def _sign(payload):
-    data = json.dumps(payload, separators=(",", ":"))
-    sig = hashlib.sha256((data + APP_SECRET).encode()).hexdigest()
-    return f"{data}.{sig}"
+    data = orjson.dumps(payload)
+    return (data + b"." + _mac(data)).decode()
 
-def _verify(token):
+@lru_cache(maxsize=8192)
+def _decode_token(token):
     try:
-        data, sig = token.rsplit(".", 1)
-        if hashlib.sha256((data + APP_SECRET).encode()).hexdigest() != sig:
-            return None
-        p = json.loads(data)
+        data, sig = token.encode().rsplit(b".", 1)
+        p = orjson.loads(data)
         if "exp" in p and time.time() > p["exp"]:
             return None
+        if not (hmac.compare_digest(_mac(data), sig) or hmac.compare_digest(_legacy_mac(data), sig)):
+            return None
         return p
     except Exception:
         return None
 
+def _verify(token):
+    p = _decode_token(token)
+    if p is None or ("exp" in p and time.time() > p["exp"]):
+        return None
+    return p
+
 def issue_token(uid, username):
-    return _sign({"uid": uid, "username": username, "exp": time.time() + 60*60*24*7})
+    return _sign({"uid": uid, "username": username, "exp": int(time.time()) + 60*60*24*7})
 
 def require_auth(fn):
     @wraps(fn)
     def wrapper(*a, **kw):
-        auth = request.headers.get("Authorization", "")
-        if not auth.startswith("Bearer "):
-            return jsonify({"error": "unauthorized"}), 401
-        p = _verify(auth[7:])
+        p = g.get("user")
+        if p is None:
+            auth = request.headers.get("Authorization", "")
+            token = auth.removeprefix("Bearer ")
+            p = g.user = (token != auth and _verify(token)) or False
         if not p:
             return jsonify({"error": "unauthorized"}), 401
         return fn(user=p, *a, **kw)
     return wrapper
 
-def get_meteomatics_summary(lat, lon, date_iso):
+def _first(d):
+    return next(iter(d.values()), None)
+
+def _nasa_value(param, key):
+    v = _first(param.get(key) or {})
+    return None if v is None or v == NASA_FILL_VALUE else v
+
+def _get_json(url, max_bytes, **kw):
+    with HTTP.get(url, stream=True, **kw) as r:
+        if r.status_code != 200:
+            return None
+        buf = bytearray()
+        for chunk in r.iter_content(8192):
+            buf += chunk
+            if len(buf) > max_bytes:
+                app.logger.warning(f"[Upstream too large] {url}")
+                return None
+    return orjson.loads(buf)
+
+def ttl_cache(ttl, precision=4, maxsize=CACHE_MAX_ENTRIES, neg_ttl=0):
+    def deco(fn):
+        cache = {}
+        inflight = {}
+        lock = threading.Lock()
+        @wraps(fn)
+        def wrapper(lat, lon, *rest):
+            key = (round(lat, precision), round(lon, precision)) + rest
+            now = time.time()
+            with lock:
+                hit = cache.get(key)
+                if hit and now < hit[0]:
+                    return hit[1]
+                call = inflight.get(key)
+                leader = call is None
+                if leader:
+                    call = inflight[key] = {"done": threading.Event(), "val": None}
+            if not leader:
+                call["done"].wait()
+                return call["val"]
+            try:
+                val = call["val"] = fn(lat, lon, *rest)
+                if val:
+                    store(key, val, now)
+                elif neg_ttl:
+                    store(key, val, now, neg_ttl)
+            finally:
+                with lock:
+                    inflight.pop(key, None)
+                call["done"].set()
+            return val
+        def store(key, val, now, life=None):
+            with lock:
+                cache.pop(key, None)
+                if len(cache) >= maxsize:
+                    cache.pop(next(iter(cache)))
+                cache[key] = (now + (life or (ttl(*key) if callable(ttl) else ttl)), val)
+        def peek(lat, lon, *rest):
+            hit = cache.get((round(lat, precision), round(lon, precision)) + rest)
+            return (hit[1] or None) if hit and time.time() < hit[0] else None
+        def prime(val, lat, lon, *rest):
+            if val:
+                store((round(lat, precision), round(lon, precision)) + rest, val, time.time())
+        wrapper.cache = cache
+        wrapper.peek = peek
+        wrapper.prime = prime
+        return wrapper
+    return deco
+
+def _observed_ttl(live_ttl):
+    def ttl(lat, lon, day):
+        return CACHE_TTL_OBSERVED if day < dt.date.today() - dt.timedelta(days=7) else live_ttl
+    return ttl
+
+@ttl_cache(_observed_ttl(CACHE_TTL_FORECAST), precision=2)
+def get_meteomatics_summary(lat, lon, day):
     if not (MM_USER and MM_PASS):
         return None
     try:
-        d = dt.datetime.fromisoformat(date_iso)
-        params = "t_max_2m_24h:C,t_min_2m_24h:C,precip_24h:mm"
-        url = f"https://api.meteomatics.com/{d:%Y-%m-%dT00:00:00Z}/{params}/{lat:.4f},{lon:.4f}/json"
-        r = requests.get(url, auth=(MM_USER, MM_PASS), timeout=15)
-        if r.status_code != 200:
+        url = f"https://api.meteomatics.com/{day:%Y-%m-%dT00:00:00Z}/{MM_SUMMARY_PARAMS}/{lat:.4f},{lon:.4f}/json"
+        js = _get_json(url, MAX_BYTES_MM, auth=(MM_USER, MM_PASS), timeout=15)
+        if js is None:
             return None
-        js = r.json()
-        data = {p["parameter"]: p["coordinates"][0]["dates"][0]["value"] for p in js.get("data", []) if p.get("coordinates")}
-        return {"t_max": data.get("t_max_2m_24h:C"), "t_min": data.get("t_min_2m_24h:C"), "precip_24h": data.get("precip_24h:mm", 0), "source": "meteomatics"}
+        return _mm_summary(js.get("data", ()))
     except Exception:
         return None
 
-def get_nasa_power(lat, lon, date_iso):
+def _mm_summary(data, j=0):
+    tmax = tmin = gust = None; precip = 0; seen = False
+    for p in data:
+        c = p.get("coordinates")
+        if not c:
+            continue
+        v = c[j]["dates"][0]["value"]
+        name = p["parameter"]
+        if name == "t_max_2m_24h:C": tmax = v
+        elif name == "t_min_2m_24h:C": tmin = v
+        elif name == "precip_24h:mm": precip = v
+        elif name == "wind_gusts_10m_24h:ms": gust = v
+        seen = True
+    if not seen:
+        return None
+    return {"t_max": tmax, "t_min": tmin, "precip_24h": precip, "wind_gust_max": gust, "source": "meteomatics"}
+
+def get_meteomatics_batch(points, day):
+    out = [get_meteomatics_summary.peek(la, lo, day) for la, lo in points]
+    cells = {}
+    for i, (la, lo) in enumerate(points):
+        if out[i] is None:
+            cells.setdefault((round(la, 2), round(lo, 2)), []).append(i)
+    if not cells or not (MM_USER and MM_PASS):
+        return out
+    groups = list(cells.values())
     try:
-        d = dt.datetime.fromisoformat(date_iso)
-        url = ("https://power.larc.nasa.gov/api/temporal/daily/point"
-               f"?parameters=T2M_MAX,T2M_MIN,PRECTOTCORR,ALLSKY_SFC_SW_DWN"
-               f"&community=RE&longitude={lon:.4f}&latitude={lat:.4f}"
-               f"&start={d:%Y%m%d}&end={d:%Y%m%d}&format=JSON")
-        r = requests.get(url, timeout=12)
-        if r.status_code != 200:
+        coords = "+".join(f"{points[g[0]][0]:.4f},{points[g[0]][1]:.4f}" for g in groups)
+        url = f"https://api.meteomatics.com/{day:%Y-%m-%dT00:00:00Z}/{MM_SUMMARY_PARAMS}/{coords}/json"
+        js = _get_json(url, MAX_BYTES_MM, auth=(MM_USER, MM_PASS), timeout=15)
+    except Exception as e:
+        app.logger.warning(f"[meteomatics batch] {e!r}")
+        js = None
+    if js is None:
+        return out
+    data = js.get("data", ())
+    missing = []
+    for j, g in enumerate(groups):
+        try:
+            summary = _mm_summary(data, j)
+        except (LookupError, TypeError):
+            summary = None
+        if summary is None:
+            missing.append(g)
+            continue
+        get_meteomatics_summary.prime(summary, *points[g[0]], day)
+        for i in g:
+            out[i] = summary
+    if missing:
+        app.logger.warning(f"[meteomatics batch] falling back to per-point fetch for {len(missing)} points")
+    for g in missing:
+        summary = get_meteomatics_summary(*points[g[0]], day)
+        for i in g:
+            out[i] = summary
+    return out
+
+@ttl_cache(_observed_ttl(CACHE_TTL_CLIMATE), precision=2)
+def get_nasa_power(lat, lon, day):
+    try:
+        url = NASA_POWER_URL.format(lat=lat, lon=lon, day=f"{day:%Y%m%d}")
+        js = _get_json(url, MAX_BYTES_NASA, timeout=12)
+        if js is None:
+            return None
+        param = js.get("properties", {}).get("parameter", {})
+        tmax, tmin, precip, solar = (_nasa_value(param, k) for k in ("T2M_MAX", "T2M_MIN", "PRECTOTCORR", "ALLSKY_SFC_SW_DWN"))
+        if tmax is None and tmin is None and precip is None:
             return None
-        param = r.json().get("properties", {}).get("parameter", {})
-        tmax = list(param.get("T2M_MAX", {}).values())[0]
-        tmin = list(param.get("T2M_MIN", {}).values())[0]
-        precip = list(param.get("PRECTOTCORR", {}).values())[0]
-        solar = list(param.get("ALLSKY_SFC_SW_DWN", {}).values())[0]
-        return {"tmax": tmax, "tmin": tmin, "avg_temp": (tmax + tmin)/2.0, "precip": precip, "solar": solar, "source": "nasa_power"}
+        avg_temp = (tmax + tmin)/2.0 if tmax is not None and tmin is not None else None
+        return {"tmax": tmax, "tmin": tmin, "avg_temp": avg_temp, "precip": precip, "solar": solar, "source": "nasa_power"}
     except Exception:
         return None
 
+def _result(fut, timeout):
+    try:
+        return fut.result(timeout=timeout)
+    except FutureTimeout:
+        return None
+
+def _parse_day(value):
+    try:
+        return dt.datetime.fromisoformat(value).date()
+    except (TypeError, ValueError):
+        return None
+
+def fetch_conditions(lat, lon, day):
+    f_mm = UPSTREAM_POOL.submit(get_meteomatics_summary, lat, lon, day)
+    f_nasa = UPSTREAM_POOL.submit(get_nasa_power, lat, lon, day)
+    start = time.time()
+    mm = _result(f_mm, UPSTREAM_TIMEOUT_MM)
+    return mm, _result(f_nasa, max(start + UPSTREAM_TIMEOUT_NASA - time.time(), 0))
+
+def prefetch_conditions(lat, lon, date_iso):
+    day = _parse_day(date_iso)
+    if lat is None or lon is None or day is None:
+        return
+    key = (round(lat, 2), round(lon, 2), day)
+    if key in PREFETCHING:
+        return
+    PREFETCHING.add(key)
+    def run():
+        try:
+            get_meteomatics_summary(lat, lon, day)
+            get_nasa_power(lat, lon, day)
+        finally:
+            PREFETCHING.discard(key)
+    UPSTREAM_POOL.submit(run)
+
+def classify_conditions(tmax, rain):
+    if tmax is not None and tmax >= HOT_TMAX_C: return "very hot"
+    if rain >= WET_PRECIP_MM: return "very wet"
+    if tmax is not None and tmax <= COOL_TMAX_C: return "cool"
+    return "fair"
+
 def interpret_conditions(m, event_name):
     if not m:
         return "mixed conditions", ["bring umbrella just in case", "water bottle", "sunscreen"]
-    tips = []
-    tmax = m.get("t_max"); rain = m.get("precip_24h", 0) or 0
-    if tmax is not None and tmax >= 33: label = "very hot"
-    elif rain >= 10: label = "very wet"
-    elif tmax is not None and tmax <= 18: label = "cool"
-    else: label = "fair"
-    if label == "very hot": tips += ["bring shade/canopy", "portable fans", "stay hydrated"]
-    if label == "very wet": tips += ["raincoat", "waterproof bag", "check shelter options"]
-    if label == "cool": tips += ["light jacket"]
-    e = (event_name or "").lower()
-    if any(k in e for k in ["drone", "flying", "aerial"]): tips += ["check wind before flight", "bring ND filters", "spare batteries", "consider skipping if winds exceed 10 m/s"]
-    elif any(k in e for k in ["wedding", "ceremony", "party"]): tips += ["confirm canopy vendor", "backup indoor location", "protect photo gear"]
-    elif any(k in e for k in ["picnic", "bbq", "beach", "park"]): tips += ["cooler with ice", "sunscreen", "ground mat"]
-    elif any(k in e for k in ["hike", "trail", "trek"]): tips += ["hydration pack", "insect repellent", "trail shoes"]
-    seen = set()
-    tips = [t for t in tips if not (t in seen or seen.add(t))]
+    label = classify_conditions(m.get("t_max"), m.get("precip_24h", 0) or 0)
+    tips = list(CONDITION_TIPS.get(label, ()))
+    cats = {KEYWORD_CATEGORY[mt.group()] for mt in EVENT_PATTERN.finditer((event_name or "").lower())}
+    cat = next((c for c in CATEGORY_TIPS if c in cats), None)
+    if cat: tips.extend(CATEGORY_TIPS[cat])
+    tips = list(dict.fromkeys(tips))
     return label, tips
 
+@contextmanager
+def db_cursor(dict_rows=True):
+    conn = g.get("db")
+    if conn is None:
+        conn = g.db = _checkout()
+    with conn, conn.cursor(cursor_factory=RealDictCursor if dict_rows else None) as c:
+        yield c
+
+def release_db():
+    conn = g.pop("db", None)
+    if conn is not None:
+        _checkin(conn)
+
+@app.teardown_request
+def _release_db(exc):
+    release_db()
+
+def _invalidate_events(uid):
+    EVENTS_CACHE.pop(uid, None)
+
+def _json(obj, status=200):
+    return app.response_class(orjson.dumps(obj), status=status, mimetype="application/json")
+
+@app.before_request
+def _strip_compress_etag_suffix():
+    # Flask-Compress tags compressed bodies as "<etag>:br"; compare against the uncompressed tag.
+    inm = request.environ.get("HTTP_IF_NONE_MATCH")
+    if inm and ":" in inm:
+        request.environ["HTTP_IF_NONE_MATCH"] = COMPRESS_ETAG_SUFFIX.sub('"', inm)
+
+def cached_json(obj, max_age):
+    resp = _json(obj)
+    resp.set_etag(hashlib.blake2b(resp.get_data(), digest_size=8).hexdigest())
+    resp.headers["Cache-Control"] = f"public, max-age={max_age}"
+    return resp.make_conditional(request)
+
+def _events_response(body, etag):
+    resp = app.response_class(body, mimetype="application/json")
+    resp.set_etag(etag, weak=True)
+    resp.headers["Cache-Control"] = "private, max-age=0, must-revalidate"
+    return resp.make_conditional(request)
+
+def _s(d, k):
+    v = d.get(k)
+    return v.strip() if isinstance(v, str) else ""
+
+def _event_fields(d):
+    name, date = _s(d, "event_name"), _s(d, "date")
+    if not name or not date:
+        return None
+    return name, date, _s(d, "city") or None, _s(d, "country") or None, d.get("lat"), d.get("lon")
+
+@dataclass(slots=True)
+class Suggestion:
+    predicted: str
+    advice: list
+    metrics: dict
+    nasa_power: dict
+    note: str = "Forecast fused from Meteomatics and NASA POWER climatology."
+
+@dataclass(slots=True)
+class BatchSuggestion(Suggestion):
+    event_id: int | None = None
+
+def _suggestion(mm, nasa, event_name, cls=Suggestion, **extra):
+    label, tips = interpret_conditions(mm, event_name)
+    stats_text = None
+    if mm:
+        tmax = mm.get("t_max"); rain = mm.get("precip_24h") or 0
+        if tmax is not None:
+            stats_text = f"(Max {tmax:.1f}°C, Rain {rain:.1f} mm)"
+    elif nasa:
+        stats_text = f"(Max {nasa.get('tmax') or 0:.1f}°C, Rain {nasa.get('precip') or 0:.1f} mm)"
+    return cls(f"{label} {stats_text or ''}".strip(), tips, mm or {}, nasa or {}, **extra)
+
 def _wants_json():
     a = request.headers.get("Accept",""); c = request.headers.get("Content-Type","")
     return ("application/json" in a) or ("application/json" in c)
@@ -181,7 +599,7 @@ def _wants_json():
 @app.errorhandler(404)
 def _404(e):
     if _wants_json(): return jsonify({"error":"not found"}),404
-    if request.method=="GET": return send_from_directory("/app/static","index.html")
+    if request.method=="GET": return send_file(INDEX_HTML)
     return "Not found",404
 
 @app.errorhandler(500)
@@ -189,175 +607,276 @@ def _500(e):
     app.logger.error(f"[500] {e}")
     return (jsonify({"error":"server error"}),500) if _wants_json() else ("Server error",500)
 
+@app.errorhandler(psycopg2.pool.PoolError)
+def _503(e):
+    app.logger.warning(f"[503] {e}")
+    return jsonify({"error":"server busy"}),503
+
 @app.get("/health")
-def health(): return jsonify({"ok": True, "ts": time.time()})
+def health(): return _json({"ok": True, "ts": int(time.time())})
 
 @app.post("/signup")
 def signup():
-    init_db_pool()
     d=request.get_json(force=True)
-    u=(d.get("username") or "").strip().lower()
-    p=(d.get("pin") or "").strip()
-    if not u or not p.isdigit() or len(p)!=4: return jsonify({"error":"invalid"}),400
+    u=_s(d,"username").lower()
+    p=_s(d,"pin")
+    if not u or not PIN_RE.fullmatch(p): return jsonify({"error":"invalid"}),400
     ph=_hash_pin(u,p)
-    conn=db_pool.getconn()
-    try:
-        with conn,conn.cursor(cursor_factory=RealDictCursor) as c:
-            c.execute("INSERT INTO app_users(username,pin_hash) VALUES(%s,%s) ON CONFLICT(username) DO NOTHING RETURNING id;",(u,ph))
-            row=c.fetchone()
-            if not row:
-                c.execute("SELECT id,pin_hash FROM app_users WHERE username=%s;",(u,))
-                row2=c.fetchone()
-                if not row2 or row2["pin_hash"]!=ph: return jsonify({"error":"username exists"}),409
-                uid=row2["id"]
-            else: uid=row["id"]
-    finally: db_pool.putconn(conn)
-    return jsonify({"ok":True,"token":issue_token(uid,u)})
+    with db_cursor(dict_rows=False) as c:
+        _execute_prepared(c,"upsert_user",(u,ph))
+        row=c.fetchone()
+    release_db()
+    if not row or (not hmac.compare_digest(row[1],ph) and not _check_pin(u,p,row[1])): return jsonify({"error":"username exists"}),409
+    return _json({"ok":True,"token":issue_token(row[0],u)})
 
 @app.post("/login")
 def login():
-    init_db_pool()
     d=request.get_json(force=True)
-    u=(d.get("username") or "").strip().lower()
-    p=(d.get("pin") or "").strip()
-    if not u or not p.isdigit() or len(p)!=4: return jsonify({"error":"invalid"}),400
-    ph=_hash_pin(u,p)
-    conn=db_pool.getconn()
-    try:
-        with conn,conn.cursor(cursor_factory=RealDictCursor) as c:
-            c.execute("SELECT id,pin_hash FROM app_users WHERE username=%s;",(u,))
-            row=c.fetchone()
-            if not row or row["pin_hash"]!=ph: return jsonify({"error":"invalid"}),401
-            uid=row["id"]
-    finally: db_pool.putconn(conn)
-    return jsonify({"ok":True,"token":issue_token(uid,u)})
+    u=_s(d,"username").lower()
+    p=_s(d,"pin")
+    if not u or not PIN_RE.fullmatch(p): return jsonify({"error":"invalid"}),400
+    with db_cursor(dict_rows=False) as c:
+        _execute_prepared(c,"select_user",(u,))
+        row=c.fetchone()
+    release_db()
+    if not row or not _check_pin(u,p,row[1]): return jsonify({"error":"invalid"}),401
+    uid,stored=row
+    if not stored.startswith("scrypt$"):
+        ph=_hash_pin(u,p)
+        with db_cursor(dict_rows=False) as c:
+            _execute_prepared(c,"update_pin",(ph,uid))
+    return _json({"ok":True,"token":issue_token(uid,u)})
 
 @app.get("/events")
 @require_auth
 def list_events(user):
-    init_db_pool()
-    conn=db_pool.getconn()
-    try:
-        with conn,conn.cursor(cursor_factory=RealDictCursor) as c:
-            c.execute("""SELECT id,event_name,date::text AS date,city,country,lat,lon FROM events WHERE user_id=%s ORDER BY date ASC,id ASC;""",(user["uid"],))
-            return jsonify(c.fetchall())
-    finally: db_pool.putconn(conn)
+    uid=user["uid"]
+    if request.args.keys() & {"limit","after_date","after_id"}:
+        return _events_page(uid)
+    with db_cursor(dict_rows=False) as c:
+        _execute_prepared(c,"events_version",(uid,))
+        etag=hashlib.blake2b(f"{uid}:{c.fetchone()}".encode(),digest_size=8).hexdigest()
+        if request.if_none_match.contains_weak(etag): return _events_response(b"",etag)
+        hit=EVENTS_CACHE.get(uid)
+        if hit and hit[1]==etag: return _events_response(hit[0],etag)
+        _execute_prepared(c,"list_events",(uid,))
+        body=c.fetchone()[0].encode()
+    if len(EVENTS_CACHE)>=CACHE_MAX_ENTRIES: EVENTS_CACHE.pop(next(iter(EVENTS_CACHE)),None)
+    EVENTS_CACHE[uid]=(body,etag)
+    return _events_response(body,etag)
+
+def _events_page(uid):
+    limit=min(max(request.args.get("limit",EVENTS_PAGE_DEFAULT,type=int),1),EVENTS_PAGE_MAX)
+    after_date=_parse_day(request.args.get("after_date","0001-01-01"))
+    after_id=request.args.get("after_id",0,type=int)
+    if after_date is None: return jsonify({"error":"invalid after_date"}),400
+    with db_cursor(dict_rows=False) as c:
+        _execute_prepared(c,"list_events_page",(uid,after_date,after_id,limit))
+        body,n,last=c.fetchone()
+    resp=app.response_class(body.encode(),mimetype="application/json")
+    if n==limit: resp.headers["X-Next-After"]=last
+    return resp
 
 @app.post("/events")
 @require_auth
 def create_event(user):
-    init_db_pool()
+    f=_event_fields(request.get_json(force=True))
+    if not f: return jsonify({"error":"missing fields"}),400
+    with db_cursor() as c:
+        _execute_prepared(c,"insert_event",(user["uid"],*f))
+        row=c.fetchone()
+    _invalidate_events(user["uid"])
+    prefetch_conditions(row["lat"],row["lon"],row["date"])
+    return jsonify(row),201
+
+@app.post("/events/bulk")
+@require_auth
+def create_events_bulk(user):
     d=request.get_json(force=True)
-    name=(d.get("event_name") or "").strip()
-    date=(d.get("date") or "").strip()
-    city=(d.get("city") or "").strip() or None
-    country=(d.get("country") or "").strip() or None
-    lat=d.get("lat"); lon=d.get("lon")
-    if not name or not date: return jsonify({"error":"missing fields"}),400
-    conn=db_pool.getconn()
-    try:
-        with conn,conn.cursor(cursor_factory=RealDictCursor) as c:
-            c.execute("""INSERT INTO events(user_id,event_name,date,city,country,lat,lon) VALUES(%s,%s,%s,%s,%s,%s,%s) RETURNING id,event_name,date::text AS date,city,country,lat,lon;""",(user["uid"],name,date,city,country,lat,lon))
-            return jsonify(c.fetchone()),201
-    finally: db_pool.putconn(conn)
+    if not isinstance(d,list) or not d: return jsonify({"error":"expected a list of events"}),400
+    if len(d)>BULK_EVENTS_MAX: return jsonify({"error":f"at most {BULK_EVENTS_MAX} events per request"}),400
+    rows=[]
+    for it in d:
+        f=isinstance(it,dict) and _event_fields(it)
+        if not f: return jsonify({"error":"missing fields"}),400
+        rows.append((user["uid"],*f))
+    with db_cursor() as c:
+        out=execute_values(c,"""INSERT INTO events(user_id,event_name,date,city,country,lat,lon) VALUES %s RETURNING id,event_name,date::text AS date,city,country,lat,lon;""",rows,page_size=len(rows),fetch=True)
+    _invalidate_events(user["uid"])
+    return jsonify(out),201
 
 @app.put("/events/<int:event_id>")
 @require_auth
 def update_event(user, event_id):
-    init_db_pool()
-    d=request.get_json(force=True)
-    name=(d.get("event_name") or "").strip()
-    date=(d.get("date") or "").strip()
-    city=(d.get("city") or "").strip() or None
-    country=(d.get("country") or "").strip() or None
-    lat=d.get("lat"); lon=d.get("lon")
-    if not name or not date: return jsonify({"error":"missing fields"}),400
-    conn=db_pool.getconn()
-    try:
-        with conn,conn.cursor(cursor_factory=RealDictCursor) as c:
-            c.execute("""UPDATE events SET event_name=%s,date=%s,city=%s,country=%s,lat=%s,lon=%s,updated_at=NOW() WHERE id=%s AND user_id=%s RETURNING id,event_name,date::text AS date,city,country,lat,lon;""",(name,date,city,country,lat,lon,event_id,user["uid"]))
-            row=c.fetchone()
-            if not row: return jsonify({"error":"not found"}),404
-            return jsonify(row)
-    finally: db_pool.putconn(conn)
+    f=_event_fields(request.get_json(force=True))
+    if not f: return jsonify({"error":"missing fields"}),400
+    with db_cursor() as c:
+        _execute_prepared(c,"update_event",(*f,event_id,user["uid"]))
+        row=c.fetchone()
+    if not row: return jsonify({"error":"not found"}),404
+    _invalidate_events(user["uid"])
+    prefetch_conditions(row["lat"],row["lon"],row["date"])
+    return jsonify(row)
 
 @app.post("/suggest")
 @require_auth
 def suggest(user):
     d=request.get_json(force=True)
-    event_name=(d.get("event_name") or "").strip()
+    event_name=_s(d,"event_name")
     date=d.get("date"); lat=d.get("lat"); lon=d.get("lon")
     event_id=d.get("event_id")
     if event_id and (not date or lat is None or lon is None or not event_name):
-        conn=db_pool.getconn()
-        try:
-            with conn,conn.cursor(cursor_factory=RealDictCursor) as c:
-                c.execute("""SELECT event_name,date::text AS date,lat,lon FROM events WHERE id=%s AND user_id=%s;""",(event_id,user["uid"]))
-                row=c.fetchone()
-                if not row: return jsonify({"error":"event not found"}),404
-                event_name=event_name or row["event_name"]; date=date or row["date"]
-                lat=lat if lat is not None else row["lat"]; lon=lon if lon is not None else row["lon"]
-        finally: db_pool.putconn(conn)
+        with db_cursor() as c:
+            _execute_prepared(c,"select_event",(event_id,user["uid"]))
+            row=c.fetchone()
+            if not row: return jsonify({"error":"event not found"}),404
+            event_name=event_name or row["event_name"]; date=date or row["date"]
+            lat=lat if lat is not None else row["lat"]; lon=lon if lon is not None else row["lon"]
+        release_db()
     mm=nasa=None
-    if date and lat and lon:
-        mm=get_meteomatics_summary(float(lat),float(lon),date)
-        nasa=get_nasa_power(float(lat),float(lon),date)
-    label,tips=interpret_conditions(mm,event_name)
-    stats_text=None
-    if mm:
-        tmax=mm.get("t_max"); rain=mm.get("precip_24h",0)
-        if tmax is not None:
-            stats_text=f"(Max {tmax:.1f}°C, Rain {rain:.1f} mm)"
-    elif nasa:
-        stats_text=f"(Max {nasa.get('tmax',0):.1f}°C, Rain {nasa.get('precip',0):.1f} mm)"
-    return jsonify({"predicted": f"{label} {stats_text or ''}".strip(), "advice": tips, "metrics": mm or {}, "nasa_power": nasa or {}, "note": "Forecast fused from Meteomatics and NASA POWER climatology."})
+    day=_parse_day(date)
+    if day and lat and lon:
+        mm,nasa=fetch_conditions(float(lat),float(lon),day)
+    return _json(_suggestion(mm,nasa,event_name))
 
-@app.get("/current_weather")
-def current_weather():
-    lat = request.args.get("lat", type=float)
-    lon = request.args.get("lon", type=float)
-    if lat is None or lon is None or not (MM_USER and MM_PASS):
-        return jsonify({})
+@app.post("/suggest_batch")
+@require_auth
+def suggest_batch(user):
+    d=request.get_json(force=True)
+    if not isinstance(d,list) or not d or not all(isinstance(it,dict) for it in d): return jsonify({"error":"expected a list of events"}),400
+    if len(d)>SUGGEST_BATCH_MAX: return jsonify({"error":f"at most {SUGGEST_BATCH_MAX} events per request"}),400
+    items=[{"event_id":it.get("event_id"),"event_name":_s(it,"event_name"),"date":it.get("date"),"lat":it.get("lat"),"lon":it.get("lon")} for it in d]
+    ids=[it["event_id"] for it in items if it["event_id"] and (not it["date"] or it["lat"] is None or it["lon"] is None or not it["event_name"])]
+    if ids:
+        with db_cursor() as c:
+            _execute_prepared(c,"select_events",(user["uid"],ids))
+            rows={r["id"]:r for r in c.fetchall()}
+        release_db()
+        for it in items:
+            row=rows.get(it["event_id"])
+            if row:
+                for k in ("event_name","date","lat","lon"):
+                    if it[k] is None or it[k]=="": it[k]=row[k]
+    by_date={}; pts={}
+    for i,it in enumerate(items):
+        day=_parse_day(it["date"])
+        if day and it["lat"] and it["lon"]:
+            by_date.setdefault(day,[]).append(i)
+            pts[i]=(float(it["lat"]),float(it["lon"]))
+    cells={}
+    for day,idx in by_date.items():
+        for i in idx: cells.setdefault((round(pts[i][0],2),round(pts[i][1],2),day),[]).append(i)
+    mm=[None]*len(items); nasa=[None]*len(items)
+    mm_futs={day:BATCH_POOL.submit(get_meteomatics_batch,[pts[i] for i in idx],day) for day,idx in by_date.items()}
+    nasa_futs={k:BATCH_POOL.submit(get_nasa_power,*pts[idx[0]],k[2]) for k,idx in cells.items()}
+    start=time.time()
+    for day,f in mm_futs.items():
+        for i,v in zip(by_date[day],_result(f,max(start+UPSTREAM_TIMEOUT_MM-time.time(),0)) or ()):
+            mm[i]=v
+    for k,f in nasa_futs.items():
+        v=_result(f,max(start+UPSTREAM_TIMEOUT_NASA-time.time(),0))
+        for i in cells[k]: nasa[i]=v
+    for f in (*mm_futs.values(),*nasa_futs.values()): f.cancel()
+    return _json([_suggestion(mm[i],nasa[i],it["event_name"],BatchSuggestion,event_id=it["event_id"]) for i,it in enumerate(items)])
+
+@ttl_cache(CACHE_TTL_CURRENT, precision=2)
+def get_current_weather(lat, lon, hour):
     try:
-        now = dt.datetime.utcnow().replace(minute=0, second=0, microsecond=0)
         params = "t_2m:C,weather_symbol_1h:idx"
-        url = f"https://api.meteomatics.com/{now:%Y-%m-%dT%H:%M:%SZ}/{params}/{lat:.4f},{lon:.4f}/json"
-        r = requests.get(url, auth=(MM_USER, MM_PASS), timeout=10)
+        url = f"https://api.meteomatics.com/{hour:%Y-%m-%dT%H:%M:%SZ}/{params}/{lat:.4f},{lon:.4f}/json"
+        js = _get_json(url, MAX_BYTES_MM, auth=(MM_USER, MM_PASS), timeout=10)
         desc = "Unknown"; temp = None
-        if r.status_code == 200:
-            js = r.json()
-            vals = {p["parameter"]: p["coordinates"][0]["dates"][0]["value"] for p in js.get("data", []) if p.get("coordinates")}
-            temp = vals.get("t_2m:C"); sym = vals.get("weather_symbol_1h:idx")
+        if js is not None:
+            sym = None
+            for p in js.get("data", ()):
+                c = p.get("coordinates")
+                if not c:
+                    continue
+                if p["parameter"] == "t_2m:C": temp = c[0]["dates"][0]["value"]
+                elif p["parameter"] == "weather_symbol_1h:idx": sym = c[0]["dates"][0]["value"]
             if sym is not None:
                 try: code = int(sym)
                 except: code = 0
-                desc = {1:"Clear",2:"Mostly clear",3:"Partly cloudy",4:"Overcast",5:"Fog",6:"Light rain",7:"Rain",8:"Heavy rain",9:"Snow",10:"Thunderstorms"}.get(code,"Unknown")
+                desc = WX_DESC[code] if 0 <= code < len(WX_DESC) else "Unknown"
         if temp is None:
-            return jsonify({})
-        return jsonify({"temp": temp, "desc": desc})
+            return {}
+        return {"temp": temp, "desc": desc}
     except Exception:
+        return {}
+
+@app.get("/current_weather")
+def current_weather():
+    lat = request.args.get("lat", type=float)
+    lon = request.args.get("lon", type=float)
+    if lat is None or lon is None or not (MM_USER and MM_PASS):
         return jsonify({})
+    hour = dt.datetime.utcnow().replace(minute=0, second=0, microsecond=0)
+    out = get_current_weather(lat, lon, hour)
+    return cached_json(out, CACHE_TTL_CURRENT) if out else jsonify({})
 
-@app.get("/geo/countries")
-def geo_countries():
+def _load_country_cache():
+    try:
+        with open(COUNTRY_CACHE_FILE, "rb") as f:
+            COUNTRY_CACHE.update(orjson.loads(f.read()))
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        app.logger.warning(f"[Country cache load] {e}")
+    if not COUNTRY_CACHE["data"]:
+        try:
+            with open(BUNDLED_COUNTRIES_FILE, "rb") as f:
+                COUNTRY_CACHE["data"] = orjson.loads(f.read())
+        except Exception as e:
+            app.logger.warning(f"[Bundled countries load] {e}")
+
+def _save_country_cache():
     try:
-        now = time.time()
-        if COUNTRY_CACHE["data"] and now - COUNTRY_CACHE["ts"] < CACHE_TTL_COUNTRIES:
-            return jsonify(COUNTRY_CACHE["data"])
-        r = requests.get("https://restcountries.com/v3.1/all?fields=name,cca2", timeout=15)
-        r.raise_for_status()
+        os.makedirs(os.path.dirname(COUNTRY_CACHE_FILE), exist_ok=True)
+        tmp = f"{COUNTRY_CACHE_FILE}.{os.getpid()}"
+        with open(tmp, "wb") as f:
+            f.write(orjson.dumps(COUNTRY_CACHE))
+        os.replace(tmp, COUNTRY_CACHE_FILE)
+    except Exception as e:
+        app.logger.warning(f"[Country cache save] {e}")
+
+def _refresh_countries():
+    try:
+        js = _get_json("https://restcountries.com/v3.1/all?fields=name,cca2", MAX_BYTES_COUNTRIES, timeout=15)
+        if js is None:
+            raise ValueError("restcountries unavailable")
         out = []
-        for it in r.json():
+        for it in js:
             nm = (it.get("name",{}) or {}).get("common")
             code = it.get("cca2")
             if nm and code:
                 out.append({"name": nm, "code": code.upper()})
         out.sort(key=lambda x: x["name"])
-        COUNTRY_CACHE["data"] = out
-        COUNTRY_CACHE["ts"] = now
-        return jsonify(out)
+        COUNTRY_CACHE.update(ts=time.time(), data=out)
+        _save_country_cache()
     except Exception as e:
-        return jsonify([{"name":"Singapore","code":"SG"},{"name":"Japan","code":"JP"},{"name":"United States","code":"US"},{"name":"Malaysia","code":"MY"}])
+        COUNTRY_RETRY["at"] = time.time() + CACHE_TTL_NEGATIVE
+        app.logger.warning(f"[Country refresh] {e}")
+    finally:
+        COUNTRY_REFRESH.release()
+
+@app.get("/geo/countries")
+def geo_countries():
+    now = time.time()
+    if now - COUNTRY_CACHE["ts"] >= CACHE_TTL_COUNTRIES and now >= COUNTRY_RETRY["at"] and COUNTRY_REFRESH.acquire(blocking=False):
+        UPSTREAM_POOL.submit(_refresh_countries)
+    if COUNTRY_CACHE["data"]:
+        return cached_json(COUNTRY_CACHE["data"], HTTP_MAX_AGE_COUNTRIES)
+    return jsonify([{"name":"Singapore","code":"SG"},{"name":"Japan","code":"JP"},{"name":"United States","code":"US"},{"name":"Malaysia","code":"MY"}])
+
+def _load_static_cities():
+    try:
+        with open(os.path.join(STATIC_DIR, "data", "static_cities.json"), "rb") as f:
+            STATIC_CITIES.update(orjson.loads(f.read()))
+        for v in STATIC_CITIES.values():
+            STATIC_CITIES_BY_COUNTRY.setdefault(v.get("country", "").lower(), v)
+        app.logger.info(f"[City preload] {len(STATIC_CITIES)} countries cached")
+    except Exception as e:
+        app.logger.error(f"[City preload fail] {e}")
 
 @app.get("/geo/cities")
 def geo_cities():
@@ -365,31 +884,17 @@ def geo_cities():
     country = (request.args.get("country") or "").strip()
     if not code and not country:
         return jsonify({"cities":[]})
-    global STATIC_CITIES
-    if not STATIC_CITIES:
-        try:
-            with open("/app/static/data/static_cities.json", "r", encoding="utf-8") as f:
-                STATIC_CITIES = json.load(f)
-            app.logger.info(f"[City preload] {len(STATIC_CITIES)} countries cached")
-        except Exception as e:
-            app.logger.error(f"[City preload fail] {e}")
-            return jsonify({"code": code, "country": country, "cities":[]})
-    data = STATIC_CITIES.get(code)
-    if not data and country:
-        for k, v in STATIC_CITIES.items():
-            if v.get("country","").lower() == country.lower():
-                data = v
-                break
+    data = STATIC_CITIES.get(code) or (country and STATIC_CITIES_BY_COUNTRY.get(country.lower()))
     if not data:
         return jsonify({"code": code, "country": country, "cities":[]})
-    return jsonify({"code": code, "country": data["country"], "cities": data["cities"]})
+    return cached_json({"code": code, "country": data["country"], "cities": data["cities"]}, HTTP_MAX_AGE_CITIES)
 
+@ttl_cache(CACHE_TTL_GEOCODE, precision=3, maxsize=50000, neg_ttl=CACHE_TTL_NEGATIVE)
 def reverse_geocode_core(lat, lon):
     try:
-        r = requests.get("https://nominatim.openstreetmap.org/reverse", params={"format": "jsonv2", "lat": lat, "lon": lon, "zoom": 10, "addressdetails": 1}, headers={"User-Agent": "Plan4Cast/1.0"}, timeout=8)
-        if r.status_code != 200:
+        js = _get_json("https://nominatim.openstreetmap.org/reverse", MAX_BYTES_GEOCODE, params={"format": "jsonv2", "lat": lat, "lon": lon, "zoom": 10, "addressdetails": 1, "accept-language": NOMINATIM_LANG, **NOMINATIM_CONTACT}, timeout=8)
+        if js is None:
             return {}
-        js = r.json()
         addr = js.get("address", {})
         city = addr.get("city") or addr.get("town") or addr.get("village") or addr.get("county")
         country = addr.get("country")
@@ -404,16 +909,19 @@ def api_reverse_geocode():
     lon = request.args.get("lon", type=float)
     if lat is None or lon is None:
         return jsonify({})
-    return jsonify(reverse_geocode_core(lat, lon))
+    out = reverse_geocode_core(lat, lon)
+    return cached_json(out, CACHE_TTL_GEOCODE) if out else jsonify({})
 
 @app.get("/")
-def root(): return send_from_directory("/app/static","index.html")
+def root(): return send_file(INDEX_HTML)
 
 @app.get("/<path:path>")
 def static_proxy(path):
-    try: return send_from_directory("/app/static",path)
+    try: return send_from_directory(STATIC_DIR,path,max_age=STATIC_MAX_AGE)
     except Exception: return _404(None)
 
 init_db_pool()
+_load_country_cache()
+_load_static_cities()
 if __name__=="__main__":
     app.run(host="0.0.0.0",port=8000,debug=True)
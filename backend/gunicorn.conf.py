@@ -0,0 +1,12 @@
+import os
+
+bind = os.getenv("BIND", "0.0.0.0:8000")
+workers = int(os.getenv("WEB_CONCURRENCY", "1"))
+worker_class = "gevent"
+worker_connections = int(os.getenv("WORKER_CONNECTIONS", "1000"))
+keepalive = int(os.getenv("KEEPALIVE", "5"))
+
+def post_fork(server, worker):
+    # Let psycopg2 yield to other greenlets while waiting on Postgres.
+    from psycogreen.gevent import patch_psycopg
+    patch_psycopg()
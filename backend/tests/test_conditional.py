@@ -0,0 +1,93 @@
+import os, sys, time, unittest
+import orjson
+import psycopg2.pool
+
+# Stand-in for Postgres: records executed statements and answers prepared EXECUTEs from ROWS.
+ROWS = {}
+EXECUTED = []
+
+class FakeCursor:
+    def __init__(self, conn):
+        self.connection = conn
+        self.row = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *a):
+        pass
+
+    def execute(self, sql, args=None):
+        if sql.startswith("SHOW"):
+            self.row = ("100",)
+        elif sql.startswith("EXECUTE "):
+            name = sql[8:].split("(")[0]
+            EXECUTED.append(name)
+            self.row = ROWS.get(name)
+
+    def fetchone(self):
+        return self.row
+
+class FakeConn:
+    def __init__(self):
+        self.prepared = set()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *a):
+        pass
+
+    def cursor(self, cursor_factory=None):
+        return FakeCursor(self)
+
+class FakePool:
+    def __init__(self, minconn, maxconn, **kw):
+        self.maxconn = maxconn
+
+    def getconn(self):
+        return FakeConn()
+
+    def putconn(self, conn):
+        pass
+
+psycopg2.pool.ThreadedConnectionPool = FakePool
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import app as m
+
+BR = {"Accept-Encoding": "br"}
+
+class CompressedConditionalTest(unittest.TestCase):
+    def setUp(self):
+        self.c = m.app.test_client()
+        EXECUTED.clear()
+        m.EVENTS_CACHE.clear()
+
+    def revalidate(self, path, headers):
+        r = self.c.get(path, headers=headers)
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.headers.get("Content-Encoding"), "br")
+        etag = r.headers["ETag"]
+        m.EVENTS_CACHE.clear()
+        EXECUTED.clear()
+        return self.c.get(path, headers={**headers, "If-None-Match": etag})
+
+    def test_events_304_after_compression(self):
+        events = [{"id": i, "event_name": f"picnic {i}", "date": "2025-10-01", "city": "Tokyo", "country": "Japan", "lat": 35.68, "lon": 139.69} for i in range(20)]
+        ROWS["events_version"] = (20, 19, 123456789)
+        ROWS["list_events"] = (orjson.dumps(events).decode(),)
+        auth = {**BR, "Authorization": "Bearer " + m.issue_token(1, "alice")}
+        r = self.revalidate("/events", auth)
+        self.assertEqual(r.status_code, 304)
+        self.assertEqual(EXECUTED, ["events_version"])
+
+    def test_countries_304_after_compression(self):
+        m.COUNTRY_CACHE.update(data=[{"name": f"Country {i}", "code": f"C{i}"} for i in range(60)], ts=time.time())
+        self.assertEqual(self.revalidate("/geo/countries", BR).status_code, 304)
+
+    def test_cities_304_after_compression(self):
+        m.STATIC_CITIES["ZZ"] = {"country": "Testland", "cities": [f"City number {i}" for i in range(60)]}
+        self.assertEqual(self.revalidate("/geo/cities?code=ZZ", BR).status_code, 304)
+
+if __name__ == "__main__":
+    unittest.main()